@@ -187,7 +187,7 @@ setup(
     # executes the function `main` from this package when invoked:
     entry_points={  # Optional
         'console_scripts': [
-            'cloudtransfer=cloudtransfer:main',
+            'cloudtransfer=cloudtransfer.cli:main',
         ],
     },
 
@@ -0,0 +1,147 @@
+import json
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+logger = logging.getLogger(__name__)
+
+
+def read_manifest(lines):
+    """Parse a JSONL manifest of operations
+    :param lines: Iterable of manifest lines
+    :return: Generator of (item id, item dictionary or None, error or None).
+    The id defaults to the 1-based line number when the item has no 'id'.
+    """
+
+    for line_no, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError as e:
+            yield line_no, None, f'Invalid manifest line: {e}'
+            continue
+        if not isinstance(item, dict) or 'op' not in item:
+            yield line_no, None, 'Manifest item must be an object with "op"'
+            continue
+        yield item.get('id', line_no), item, None
+
+
+def load_results(results_path):
+    """Load the outcome of a previous run for resuming it
+    :param results_path: string. File spec of a JSONL results file
+    :return: Dictionary mapping item ids to their last result
+    """
+
+    results = {}
+    try:
+        with open(results_path, 'r') as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    # Truncated last line of an interrupted run
+                    continue
+                results[result['id']] = result
+    except FileNotFoundError:
+        pass
+    return results
+
+
+def _run_item(handler, item_id, item):
+    start = time.monotonic()
+    result = {'id': item_id, 'op': item['op']}
+    try:
+        output = handler(item)
+    except Exception as e:
+        logger.error('Item %s failed: %s', item_id, e)
+        output = None
+        result['error'] = str(e)
+    result['elapsed'] = round(time.monotonic() - start, 6)
+    if output is None:
+        result['status'] = 'failed'
+        result.setdefault('error', 'Operation failed')
+    else:
+        result['status'] = 'pending' if output.pop('pending', False) else 'ok'
+        result['result'] = output
+    return result
+
+
+def run_batch(manifest, handler, output, concurrency=8, dry_run=False,
+              validate=None, previous=None):
+    """Run every manifest item through handler on a pool of worker threads.
+    At most twice concurrency items are in flight at once, so manifests of
+    any length are processed in constant memory.
+    :param manifest: Iterable as returned by read_manifest()
+    :param handler: Callable taking an item dictionary and returning a
+    JSON-serializable dictionary, or None if the operation failed. An
+    integer 'bytes' key in the returned dictionary counts towards throughput,
+    and a true 'pending' key marks an operation that was started but must be
+    run again to complete, e.g. a Glacier retrieval job.
+    :param output: Writable text file receiving one JSON result per line
+    :param concurrency: int. Number of worker threads
+    :param dry_run: bool. If True, validate and report the items without
+    running them
+    :param validate: Callable taking an item dictionary and raising
+    ValueError if it is malformed
+    :param previous: Dictionary as returned by load_results(). Items that
+    succeeded are skipped; pending items are rerun with their previous result
+    as default item values.
+    :return: Dictionary summarizing the run
+    """
+
+    previous = previous or {}
+    counts = {'ok': 0, 'failed': 0, 'pending': 0, 'skipped': 0, 'dry-run': 0}
+    total_bytes = 0
+    start = time.monotonic()
+
+    def emit(result):
+        nonlocal total_bytes
+        counts[result['status']] += 1
+        if result['status'] == 'ok':
+            total_bytes += result['result'].get('bytes', 0)
+        output.write(json.dumps(result) + '\n')
+
+    pending = set()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for item_id, item, error in manifest:
+            if error is None and validate is not None:
+                try:
+                    validate(item)
+                except ValueError as e:
+                    error = str(e)
+            if error is not None:
+                emit({'id': item_id, 'op': item and item['op'],
+                      'status': 'failed', 'error': error})
+                continue
+            last = previous.get(item_id)
+            if last is not None and last['status'] == 'ok':
+                counts['skipped'] += 1
+                continue
+            if last is not None and last['status'] == 'pending':
+                item = dict(last['result'], **item)
+            if dry_run:
+                emit({'id': item_id, 'op': item['op'], 'status': 'dry-run'})
+                continue
+            pending.add(executor.submit(_run_item, handler, item_id, item))
+            if len(pending) >= 2 * concurrency:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    emit(future.result())
+                output.flush()
+        for future in pending:
+            emit(future.result())
+    output.flush()
+
+    elapsed = time.monotonic() - start
+    processed = counts['ok'] + counts['failed'] + counts['pending']
+    summary = dict(counts)
+    summary.update({
+        'elapsed': round(elapsed, 3),
+        'bytes': total_bytes,
+        'items_per_second': round(processed / elapsed, 3) if elapsed else 0,
+        'bytes_per_second': round(total_bytes / elapsed, 3) if elapsed else 0,
+    })
+    return summary
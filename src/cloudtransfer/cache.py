@@ -0,0 +1,234 @@
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+
+
+# Suffix of partially written entries; they are never served
+TMP_SUFFIX = '.tmp'
+# Temp files older than this are left over from an interrupted insertion and
+# are removed when the cache directory is scanned. Younger ones may belong to
+# another process sharing the directory.
+STALE_TMP_AGE = 24 * 60 * 60
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class ArchiveCache:
+    """Disk-backed LRU cache of retrieved archive contents.
+
+    Entries are keyed by a Dropbox content_hash or a Glacier archive ID and
+    stored as one file per key under cache_dir. Recency is kept in the file
+    modification times, so the LRU order survives restarts. Entries that are
+    checked out or inserted with pin=True are never evicted until released.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        """
+        :param cache_dir: string. Directory holding the cached entries.
+        :param max_bytes: int. Size cap; least recently used entries are
+        evicted once the cached total exceeds it.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._entries = None    # OrderedDict of filename -> size, LRU first
+        self._size = 0
+        self._pins = {}         # filename -> number of holders
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        name = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, name)
+
+    def _load(self):
+        """Scan cache_dir once to rebuild the LRU index"""
+        if self._entries is not None:
+            return
+        self._entries = OrderedDict()
+        self._size = 0
+        if not os.path.isdir(self.cache_dir):
+            return
+        found = []
+        stale = time.time() - STALE_TMP_AGE
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_file():
+                continue
+            st = entry.stat()
+            if entry.name.endswith(TMP_SUFFIX):
+                if st.st_mtime < stale:
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass
+                continue
+            found.append((st.st_mtime, entry.name, st.st_size))
+        for _, name, size in sorted(found):
+            self._entries[name] = size
+            self._size += size
+
+    def _evict(self):
+        # The most recent entry is kept even when it alone exceeds max_bytes,
+        # so a caller can still read back what it just inserted. Pinned
+        # entries are skipped; they are reconsidered once released.
+        newest = next(reversed(self._entries), None)
+        for name in list(self._entries):
+            if self._size <= self.max_bytes:
+                break
+            if name == newest or self._pins.get(name):
+                continue
+            size = self._entries.pop(name)
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            self._size -= size
+            logger.debug('Evicted %s (%d bytes) from archive cache',
+                         name, size)
+
+    def _lookup(self, key, pin):
+        path = self._path(key)
+        name = os.path.basename(path)
+        with self._lock:
+            self._load()
+            size = self._entries.get(name)
+            if size is None or not os.path.exists(path):
+                if size is not None:
+                    del self._entries[name]
+                    self._size -= size
+                self.misses += 1
+                return None
+            self._entries.move_to_end(name)
+            os.utime(path)
+            self.hits += 1
+            self.bytes_saved += size
+            if pin:
+                self._pins[name] = self._pins.get(name, 0) + 1
+        return path
+
+    def get(self, key):
+        """Look up a cached entry and mark it as most recently used.
+        The entry is not pinned, so with other threads inserting it may be
+        evicted before it is read; prefer checkout().
+        :param key: string. Content hash or archive ID.
+        :return: Path of the cached file, otherwise None
+        """
+        return self._lookup(key, pin=False)
+
+    @contextmanager
+    def checkout(self, key):
+        """Look up a cached entry and keep it from being evicted while the
+        with block runs
+        :param key: string. Content hash or archive ID.
+        :return: Context manager yielding the path of the cached file,
+        otherwise None
+        """
+        path = self._lookup(key, pin=True)
+        try:
+            yield path
+        finally:
+            if path is not None:
+                self.release(key)
+
+    def release(self, key):
+        """Drop one pin taken by checkout() or put(pin=True)
+        :param key: string. Content hash or archive ID.
+        """
+        name = os.path.basename(self._path(key))
+        with self._lock:
+            count = self._pins.get(name, 0) - 1
+            if count > 0:
+                self._pins[name] = count
+            else:
+                self._pins.pop(name, None)
+                self._evict()
+
+    def __contains__(self, key):
+        """Membership test that does not count as a hit or miss"""
+        name = os.path.basename(self._path(key))
+        with self._lock:
+            self._load()
+            return name in self._entries
+
+    def copy_to(self, key, dest_path):
+        """Copy a cached entry to dest_path
+        :param key: string. Content hash or archive ID.
+        :param dest_path: string. Destination file spec.
+        :return: True if the entry was cached and copied, otherwise False
+        """
+        with self.checkout(key) as path:
+            if path is None:
+                return False
+            shutil.copyfile(path, dest_path)
+        return True
+
+    def put(self, key, src, verify=None, pin=False):
+        """Atomically insert an entry, replacing any previous one for key
+        :param key: string. Content hash or archive ID.
+        :param src: bytes of data, string reference to file spec, or a
+        readable binary file object
+        :param verify: Callable invoked once src is fully written. If it
+        returns False the entry is discarded before becoming visible.
+        :param pin: bool. If True, the entry is pinned as by checkout() and
+        the caller must call release(key) once done with the path.
+        :return: Path of the cached file, or None if verify failed
+        """
+        with self._lock:
+            # Index first, so the scan does not sweep up our own temp file
+            self._load()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix=TMP_SUFFIX, dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if isinstance(src, bytes):
+                    f.write(src)
+                elif isinstance(src, str):
+                    with open(src, 'rb') as src_file:
+                        shutil.copyfileobj(src_file, f, CHUNK_SIZE)
+                else:
+                    shutil.copyfileobj(src, f, CHUNK_SIZE)
+                f.flush()
+                os.fsync(f.fileno())
+            if verify is not None and not verify():
+                os.remove(tmp_path)
+                return None
+            size = os.path.getsize(tmp_path)
+            path = self._path(key)
+            name = os.path.basename(path)
+            with self._lock:
+                os.replace(tmp_path, path)
+                old_size = self._entries.pop(name, 0)
+                self._entries[name] = size
+                self._size += size - old_size
+                if pin:
+                    self._pins[name] = self._pins.get(name, 0) + 1
+                self._evict()
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return path
+
+    def stats(self):
+        """Return cache counters
+        :return: Dictionary with hits, misses, bytes_saved, entries and size
+        """
+        with self._lock:
+            self._load()
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'bytes_saved': self.bytes_saved,
+                'entries': len(self._entries),
+                'size': self._size,
+            }
@@ -0,0 +1,212 @@
+import argparse
+import json
+import logging
+import os
+import sys
+
+from . import cloudtransfer
+from .batch import load_results, read_manifest, run_batch
+from .log import configure_logging
+
+
+# Keys each manifest operation requires
+REQUIRED_KEYS = {
+    'upload': ('vault', 'path'),
+    'download': ('vault', 'archive_id', 'dest'),
+    'transfer': ('source', 'vault'),
+    'delete': ('vault', 'archive_id'),
+    'inventory': ('vault',),
+    'scrub': ('state',),
+    'mirror': ('source', 'vault', 'state'),
+}
+
+
+def validate_item(item):
+    """Check that a manifest item names a known operation and its arguments
+    :param item: Dictionary parsed from a manifest line
+    :raises ValueError: If the item is malformed
+    """
+
+    keys = REQUIRED_KEYS.get(item['op'])
+    if keys is None:
+        raise ValueError(f'Unknown operation {item["op"]!r}')
+    missing = [key for key in keys if key not in item]
+    if missing:
+        raise ValueError(
+            f'Operation {item["op"]!r} is missing {", ".join(missing)}'
+        )
+
+
+def upload(item):
+    archive = cloudtransfer.upload_archive(item['vault'], item['path'])
+    if archive is None:
+        return None
+    return {'archiveId': archive['archiveId'],
+            'checksum': archive['checksum'],
+            'bytes': os.path.getsize(item['path'])}
+
+
+def download(item):
+    restored, job_id = cloudtransfer.restore_archive(
+        item['vault'], item['archive_id'], item['dest'], item.get('job_id')
+    )
+    if restored:
+        return {'dest': item['dest'],
+                'bytes': os.path.getsize(item['dest'])}
+    if job_id is None:
+        return None
+    return {'pending': True, 'job_id': job_id}
+
+
+def transfer(item):
+    archive = cloudtransfer.transfer_to_glacier(item['source'], item['vault'])
+    if archive is None:
+        return None
+    return {'archiveId': archive['archiveId'],
+            'checksum': archive['checksum'],
+            'bytes': archive['size']}
+
+
+def delete(item):
+    if not cloudtransfer.delete_archive(item['vault'], item['archive_id']):
+        return None
+    return {}
+
+
+def inventory(item):
+    if item.get('job_id') is None:
+        response = cloudtransfer.retrieve_inventory(item['vault'])
+        if response is None:
+            return None
+        return {'pending': True, 'job_id': response['jobId']}
+
+    # Keep waiting on an unfinished job rather than starting another one
+    job = cloudtransfer.describe_job(item['vault'], item['job_id'])
+    if job is None:
+        return None
+    if not job['Completed']:
+        return {'pending': True, 'job_id': item['job_id']}
+
+    results = cloudtransfer.retrieve_inventory_results(item['vault'],
+                                                       item['job_id'])
+    if results is None:
+        return None
+    if 'dest' in item:
+        with open(item['dest'], 'w') as f:
+            json.dump(results, f)
+    return {'VaultARN': results['VaultARN'],
+            'archives': len(results['ArchiveList'])}
+
+
+def scrub(item):
+    inventory_results = None
+    if 'inventory' in item:
+        with open(item['inventory'], 'r') as f:
+            inventory_results = json.load(f)
+    return cloudtransfer.scrub_mirror(
+        item['state'], item.get('sample', 0.01), item.get('rate', 5),
+        inventory_results
+    )
+
+
+def mirror(item):
+    # Runs until interrupted unless "once" is set; it occupies one worker
+    state = cloudtransfer.mirror_to_glacier(
+        item['source'], item['vault'], item['state'],
+        timeout=item.get('timeout', 30), once=item.get('once', False)
+    )
+    if state['retry']:
+        return None
+    return {'archives': len(state['archives'])}
+
+
+OPERATIONS = {
+    'upload': upload,
+    'download': download,
+    'transfer': transfer,
+    'delete': delete,
+    'inventory': inventory,
+    'scrub': scrub,
+    'mirror': mirror,
+}
+
+
+def run_item(item):
+    return OPERATIONS[item['op']](item)
+
+
+def main(argv=None):
+    """Run a JSONL manifest of operations from the command line.
+    Each manifest line is an object with an "op" of upload (vault, path),
+    download (vault, archive_id, dest), transfer (source, vault),
+    delete (vault, archive_id), inventory (vault, optional dest) or
+    scrub (state, optional sample, rate and inventory) or
+    mirror (source, vault, state, optional timeout and once), plus an
+    optional "id". A mirror item keeps running, following Dropbox changes,
+    unless "once" is true. Glacier retrievals report status "pending" with a
+    job_id; rerun with --resume once the job has completed.
+    :param argv: List of command line arguments, defaults to sys.argv[1:]
+    :return: Exit status, 0 if no item failed
+    """
+
+    parser = argparse.ArgumentParser(
+        prog='cloudtransfer',
+        description='Run a JSONL manifest of cloud storage operations.'
+    )
+    parser.add_argument('manifest',
+                        help='JSONL manifest file, or - for stdin')
+    parser.add_argument('-o', '--output', default='-',
+                        help='JSONL file receiving per-item results, '
+                             'or - for stdout (default)')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='number of worker threads (default: 8)')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip items that already succeeded in --output '
+                             'and append to it')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='validate and list the items without running '
+                             'them')
+    parser.add_argument('--dropbox-token',
+                        default=os.environ.get('DROPBOX_TOKEN', ''),
+                        help='Dropbox OAuth2 access token '
+                             '(default: $DROPBOX_TOKEN)')
+    parser.add_argument('--log-level', default='WARNING',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='logging threshold (default: WARNING)')
+    parser.add_argument('--log-rate', type=float, default=10.0,
+                        help='per-message rate limit, in records per second, '
+                             'for messages below WARNING (default: 10)')
+    args = parser.parse_args(argv)
+    if args.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
+    if args.resume and args.output == '-':
+        parser.error('--resume requires --output')
+
+    configure_logging(level=getattr(logging, args.log_level),
+                      rate=args.log_rate)
+    if args.dropbox_token:
+        cloudtransfer.TOKEN = args.dropbox_token
+
+    previous = load_results(args.output) if args.resume else None
+    manifest = (sys.stdin if args.manifest == '-'
+                else open(args.manifest, 'r'))
+    output = (sys.stdout if args.output == '-'
+              else open(args.output, 'a' if args.resume else 'w'))
+    try:
+        summary = run_batch(read_manifest(manifest), run_item, output,
+                            concurrency=args.concurrency,
+                            dry_run=args.dry_run, validate=validate_item,
+                            previous=previous)
+    finally:
+        if manifest is not sys.stdin:
+            manifest.close()
+        if output is not sys.stdout:
+            output.close()
+
+    summary['cache'] = cloudtransfer.archive_cache.stats()
+    print(json.dumps(summary), file=sys.stderr)
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,16 +1,33 @@
-from _typeshed import ReadableBuffer
 import logging
 import boto3
 import json
 import dropbox
 import sys
 import os
+import time
+import threading
 import configparser
+import random
+import shutil
+from contextlib import closing, contextmanager
+from itertools import chain
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from botocore.exceptions import ClientError
 from dropbox import files
 from dropbox.files import WriteMode
 from dropbox.exceptions import ApiError, AuthError
 from botocore.config import Config
+from typing import TYPE_CHECKING
+from .cache import ArchiveCache
+from .integrity import (
+    ContentHasher, HashingReader, TreeHasher, content_hash,
+    tree_hash, tree_hash_from_leaves
+)
+
+if TYPE_CHECKING:
+    from _typeshed import ReadableBuffer
+
+logger = logging.getLogger(__name__)
 
 
 proxy_definitions = {
@@ -56,7 +73,22 @@ my_aws_config = Config(
 
 aws_client = boto3.client('s3', config=my_aws_config)
 
-LOGGING_FORMAT = '%(levelname)s: %(asctime)s: %(message)s'
+_glacier_client = None
+_glacier_client_lock = threading.Lock()
+
+
+def get_glacier_client():
+    """Return the Amazon S3 Glacier client shared by all helpers.
+    Clients are thread-safe once created, but creating them from the default
+    session is not, so it is created once under a lock.
+    :return: Glacier.Client
+    """
+    global _glacier_client
+    with _glacier_client_lock:
+        if _glacier_client is None:
+            _glacier_client = boto3.client('glacier')
+    return _glacier_client
+
 
 # Add OAuth2 access token here.
 TOKEN = ''
@@ -68,6 +100,31 @@ TOKEN = ''
 LOCALFILE = 'my-file.txt'  # The file to backup
 BACKUPPATH = '/my-file-backup.txt'  # The cloud destination
 
+# Local cache of retrieved contents, keyed by Dropbox content_hash or Glacier
+# archive ID, so repeated restores skip the download or the retrieval job
+CACHEDIR = os.path.join(os.path.expanduser('~'), '.cache', 'cloudtransfer')
+CACHE_MAX_BYTES = 10 * 1024 ** 3
+
+archive_cache = ArchiveCache(CACHEDIR, CACHE_MAX_BYTES)
+
+# Times a transfer whose hash does not match the source is attempted
+VERIFY_ATTEMPTS = 3
+
+# Glacier error codes after which the same data is sent again: Glacier
+# rejects data that does not match the checksum sent with it as an invalid
+# parameter, and the others are transient
+RESEND_ERROR_CODES = {
+    'InvalidParameterValueException',
+    'RequestTimeoutException',
+    'ServiceUnavailableException',
+    'ThrottlingException',
+}
+
+# Glacier multipart part size; must be a power of two MiB (1 MiB to 4 GiB)
+PART_SIZE = 8 * 1024 * 1024
+# Parts uploaded concurrently while the next ones are read and hashed
+PART_UPLOAD_THREADS = 4
+
 
 # Uploads contents of LOCALFILE to Dropbox
 def backup():
@@ -75,10 +132,21 @@ def backup():
         # We use WriteMode=overwrite to make sure that the settings in the file
         # are changed on upload
         print("Uploading " + LOCALFILE + " to Dropbox as " + BACKUPPATH + "…")
+        data = f.read()
+        expected = content_hash(data)
         try:
-            dbx.files_upload(
-                f.read(), BACKUPPATH, mode=WriteMode('overwrite')
-            )
+            for attempt in range(VERIFY_ATTEMPTS):
+                metadata = dbx.files_upload(
+                    data, BACKUPPATH, mode=WriteMode('overwrite')
+                )
+                # Compare what landed with what we sent
+                if metadata.content_hash == expected:
+                    break
+                print("Content hash mismatch for " + BACKUPPATH
+                      + "; re-sending…")
+            else:
+                sys.exit("ERROR: Cannot back up; uploaded content does not "
+                         "match " + LOCALFILE + ".")
         except ApiError as err:
             # This checks for the specific error where a user doesn't have
             # enough Dropbox space quota to upload this file
@@ -97,7 +165,7 @@ def backup():
 
 # Change the text string in LOCALFILE to be new_content
 # @param new_content is a string
-def change_local_file(new_content: ReadableBuffer):
+def change_local_file(new_content: 'ReadableBuffer'):
     print("Changing contents of " + LOCALFILE + " on local machine…")
     with open(LOCALFILE, 'wb') as f:
         f.write(new_content)
@@ -110,14 +178,23 @@ def restore(rev=None):
         print(
             "Restoring " + BACKUPPATH + " to revision " + rev + " on Dropbox…"
         )
-        dbx.files_restore(BACKUPPATH, rev)
+        metadata = dbx.files_restore(BACKUPPATH, rev)
 
-        # Download the specific revision of the file at BACKUPPATH to LOCALFILE
-        print(
-            "Downloading current " + BACKUPPATH
-            + " from Dropbox, overwriting " + LOCALFILE + "…"
-        )
-        dbx.files_download_to_file(LOCALFILE, BACKUPPATH, rev)
+        # Download the specific revision of BACKUPPATH to LOCALFILE,
+        # verifying its content_hash on the way into the cache. The download
+        # is skipped if this content was retrieved before.
+        if metadata.content_hash in archive_cache:
+            print("Restoring " + LOCALFILE + " from local cache…")
+        else:
+            print(
+                "Downloading current " + BACKUPPATH
+                + " from Dropbox, overwriting " + LOCALFILE + "…"
+            )
+        with download_to_cache(dbx, metadata) as cached_path:
+            if cached_path is None:
+                sys.exit("ERROR: Cannot restore; download of " + BACKUPPATH
+                         + " could not be verified.")
+            shutil.copyfile(cached_path, LOCALFILE)
 
 
 # Look at all of the available revisions on Dropbox, and return the oldest one
@@ -194,7 +271,7 @@ def create_vault(vault_name):
     try:
         vault = glacier.create_vault(vaultName=vault_name)
     except ClientError as e:
-        logging.error(e)
+        logger.error(e)
         return None
     return vault
 
@@ -205,14 +282,10 @@ def test_create_vault():
     # Assign this value before running the program
     test_vault_name = 'VAULT_NAME'
 
-    # Set up logging
-    logging.basicConfig(level=logging.DEBUG,
-                        format=LOGGING_FORMAT)
-
     # Create the Glacier vault
     vault = create_vault(test_vault_name)
     if vault is not None:
-        logging.info(f'Created vault {vault.name}')
+        logger.info('Created vault %s', vault.name)
 
 
 def delete_vault(vault_name):
@@ -222,12 +295,14 @@ def delete_vault(vault_name):
     """
 
     # Delete the vault
-    glacier = boto3.client('glacier')
+    glacier = get_glacier_client()
     try:
         response = glacier.delete_vault(vaultName=vault_name)
-        logging.info(f'Received response {response} from {vault_name}')
+        logger.debug('Received HTTP %s from %s',
+                     response['ResponseMetadata']['HTTPStatusCode'],
+                     vault_name)
     except ClientError as e:
-        logging.error(e)
+        logger.error(e)
         return False
     return True
 
@@ -238,14 +313,10 @@ def test_delete_vault():
     # Assign this value before running the program
     test_vault_name = 'VAULT_NAME'
 
-    # Set up logging
-    logging.basicConfig(level=logging.DEBUG,
-                        format=LOGGING_FORMAT)
-
     # Delete the vault
     success = delete_vault(test_vault_name)
     if success:
-        logging.info(f'Deleted vault {test_vault_name}')
+        logger.info('Deleted vault %s', test_vault_name)
 
 
 def delete_archive(vault_name, archive_id):
@@ -257,16 +328,15 @@ def delete_archive(vault_name, archive_id):
     """
 
     # Delete the archive
-    glacier = boto3.client('glacier')
+    glacier = get_glacier_client()
     try:
         response = glacier.delete_archive(vaultName=vault_name,
                                           archiveId=archive_id)
-        logging.info(
-            f'Received response {response} from '
-            + '{vault_name} on archive id {archive_id}'
-        )
+        logger.debug('Received HTTP %s from %s on archive id %s',
+                     response['ResponseMetadata']['HTTPStatusCode'],
+                     vault_name, archive_id)
     except ClientError as e:
-        logging.error(e)
+        logger.error(e)
         return False
     return True
 
@@ -278,16 +348,11 @@ def test_delete_archive():
     test_vault_name = 'VAULT_NAME'
     test_archive_id = 'ARCHIVE_ID'
 
-    # Set up logging
-    logging.basicConfig(level=logging.DEBUG,
-                        format=LOGGING_FORMAT)
-
     # Delete the archive
     success = delete_archive(test_vault_name, test_archive_id)
     if success:
-        logging.info(
-            f'Deleted archive {test_archive_id} from {test_vault_name}'
-        )
+        logger.info('Deleted archive %s from %s',
+                    test_archive_id, test_vault_name)
 
 
 def describe_job(vault_name, job_id):
@@ -300,11 +365,11 @@ def describe_job(vault_name, job_id):
     """
 
     # Retrieve the status of the job
-    glacier = boto3.client('glacier')
+    glacier = get_glacier_client()
     try:
         response = glacier.describe_job(vaultName=vault_name, jobId=job_id)
     except ClientError as e:
-        logging.error(e)
+        logger.error(e)
         return None
     return response
 
@@ -316,15 +381,11 @@ def test_describe_job():
     test_vault_name = 'VAULT_NAME'
     test_job_id = 'JOB_ID'
 
-    # Set up logging
-    logging.basicConfig(level=logging.DEBUG,
-                        format=LOGGING_FORMAT)
-
     # Retrieve the job's status
     response = describe_job(test_vault_name, test_job_id)
     if response is not None:
-        logging.info(f'Job Type: {response["Action"]}, '
-                     f'Status: {response["StatusCode"]}')
+        logger.info('Job Type: %s, Status: %s',
+                    response['Action'], response['StatusCode'])
 
 
 def list_vaults(max_vaults=10, iter_marker=None):
@@ -339,7 +400,7 @@ def list_vaults(max_vaults=10, iter_marker=None):
     """
 
     # Retrieve vaults
-    glacier = boto3.client('glacier')
+    glacier = get_glacier_client()
     if iter_marker is None:
         vaults = glacier.list_vaults(limit=str(max_vaults))
     else:
@@ -351,17 +412,13 @@ def list_vaults(max_vaults=10, iter_marker=None):
 def test_list_vaults():
     """Exercise list_vaults()"""
 
-    # Set up logging
-    logging.basicConfig(level=logging.DEBUG,
-                        format=LOGGING_FORMAT)
-
     # List the vaults
     vaults, marker = list_vaults()
     while True:
         # Print info about retrieved vaults
         for vault in vaults:
-            logging.info(f'{vault["NumberOfArchives"]:3d}  '
-                         f'{vault["SizeInBytes"]:12d}  {vault["VaultName"]}')
+            logger.info('%3d  %12d  %s', vault['NumberOfArchives'],
+                        vault['SizeInBytes'], vault['VaultName'])
 
         # If no more vaults exist, exit loop, otherwise retrieve the next batch
         if marker is None:
@@ -382,12 +439,12 @@ def retrieve_inventory(vault_name):
     job_parms = {'Type': 'inventory-retrieval'}
 
     # Initiate the job
-    glacier = boto3.client('glacier')
+    glacier = get_glacier_client()
     try:
         response = glacier.initiate_job(vaultName=vault_name,
                                         jobParameters=job_parms)
     except ClientError as e:
-        logging.error(e)
+        logger.error(e)
         return None
     return response
 
@@ -398,17 +455,12 @@ def test_retrieve_inventory():
     # Assign this value before running the program
     test_vault_name = 'VAULT_NAME'
 
-    # Set up logging
-    logging.basicConfig(level=logging.DEBUG,
-                        format=LOGGING_FORMAT)
-
     # Initiate an inventory retrieval job
     response = retrieve_inventory(test_vault_name)
     if response is not None:
-        logging.info(
-            f'Initiated inventory-retrieval job for {test_vault_name}'
-        )
-        logging.info(f'Retrieval Job ID: {response["jobId"]}')
+        logger.info('Initiated inventory-retrieval job for %s',
+                    test_vault_name)
+        logger.info('Retrieval Job ID: %s', response['jobId'])
 
 
 def retrieve_inventory_results(vault_name, job_id):
@@ -420,11 +472,11 @@ def retrieve_inventory_results(vault_name, job_id):
     """
 
     # Retrieve the job results
-    glacier = boto3.client('glacier')
+    glacier = get_glacier_client()
     try:
         response = glacier.get_job_output(vaultName=vault_name, jobId=job_id)
     except ClientError as e:
-        logging.error(e)
+        logger.error(e)
         return None
 
     # Read the streaming results into a dictionary
@@ -438,23 +490,106 @@ def test_retrieve_inventory_results():
     test_vault_name = 'VAULT_NAME'
     test_job_id = 'JOB_ID'
 
-    # Set up logging
-    logging.basicConfig(level=logging.DEBUG,
-                        format=LOGGING_FORMAT)
-
     # Retrieve the job results
     inventory = retrieve_inventory_results(test_vault_name, test_job_id)
     if inventory is not None:
         # Output some of the inventory information
-        logging.info(f'Vault ARN: {inventory["VaultARN"]}')
+        logger.info('Vault ARN: %s', inventory['VaultARN'])
+        # One line per archive; rate limited by the logging configuration
         for archive in inventory['ArchiveList']:
-            logging.info(f'  Size: {archive["Size"]:6d}  '
-                         f'Archive ID: {archive["ArchiveId"]}')
+            logger.debug('  Size: %6d  Archive ID: %s',
+                         archive['Size'], archive['ArchiveId'])
+
+
+def _read_parts(object_data):
+    """Yield PART_SIZE pieces of bytes or of an open file"""
+    if isinstance(object_data, bytes):
+        for offset in range(0, max(len(object_data), 1), PART_SIZE):
+            yield object_data[offset:offset + PART_SIZE]
+        return
+    data = object_data.read(PART_SIZE)
+    yield data
+    while len(data) == PART_SIZE:
+        data = object_data.read(PART_SIZE)
+        if data:
+            yield data
+
+
+def _send_verified(operation, description, **kwargs):
+    """Call a Glacier upload operation that carries a checksum, sending the
+    same data again while Glacier rejects it or fails transiently"""
+    for attempt in range(1, VERIFY_ATTEMPTS + 1):
+        try:
+            return operation(**kwargs)
+        except ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code not in RESEND_ERROR_CODES or attempt == VERIFY_ATTEMPTS:
+                raise
+            logger.warning('%s failed with %s; re-sending (attempt %d of %d)',
+                           description, code, attempt + 1, VERIFY_ATTEMPTS)
+
+
+def _upload_single(glacier, vault_name, data):
+    """Upload one piece of data as an archive"""
+    return _send_verified(glacier.upload_archive, f'Upload to {vault_name}',
+                          vaultName=vault_name, body=data,
+                          checksum=tree_hash(data))
+
+
+def _upload_part(glacier, vault_name, upload_id, offset, data, checksum):
+    """Upload one multipart part, re-sending only this part on failure"""
+    byte_range = f'bytes {offset}-{offset + len(data) - 1}/*'
+    _send_verified(glacier.upload_multipart_part, f'Part {byte_range}',
+                   vaultName=vault_name, uploadId=upload_id,
+                   range=byte_range, checksum=checksum, body=data)
+
+
+def _upload_multipart(glacier, vault_name, parts):
+    """Upload parts as one archive. Each part is hashed as it is read while
+    the previous parts are being sent."""
+    upload_id = glacier.initiate_multipart_upload(
+        vaultName=vault_name, partSize=str(PART_SIZE)
+    )['uploadId']
+    leaves = []
+    offset = 0
+    try:
+        with ThreadPoolExecutor(max_workers=PART_UPLOAD_THREADS) as executor:
+            in_flight = set()
+            for data in parts:
+                hasher = TreeHasher()
+                hasher.update(data)
+                leaves.extend(hasher.leaves)
+                in_flight.add(executor.submit(
+                    _upload_part, glacier, vault_name, upload_id, offset,
+                    data, hasher.hexdigest()
+                ))
+                offset += len(data)
+                if len(in_flight) >= PART_UPLOAD_THREADS:
+                    done, in_flight = wait(in_flight,
+                                           return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+            for future in in_flight:
+                future.result()
+
+        checksum = tree_hash_from_leaves(leaves)
+        archive = glacier.complete_multipart_upload(
+            vaultName=vault_name, uploadId=upload_id,
+            archiveSize=str(offset), checksum=checksum
+        )
+    except BaseException:
+        glacier.abort_multipart_upload(vaultName=vault_name,
+                                       uploadId=upload_id)
+        raise
+    return archive
 
 
 def upload_archive(vault_name, src_data):
     """Add an archive to an Amazon S3 Glacier vault.
-    The upload occurs synchronously.
+    The upload occurs synchronously. Data larger than PART_SIZE is sent as a
+    multipart upload. The SHA-256 tree hash is computed while the data is
+    read and sent with each request; a part Glacier rejects against it, or
+    that fails transiently, is re-sent on its own.
     :param vault_name: string
     :param src_data: bytes of data or string reference to file spec
     :return: If src_data was added to vault, return dict of archive
@@ -470,21 +605,25 @@ def upload_archive(vault_name, src_data):
             object_data = open(src_data, 'rb')
             # possible FileNotFoundError/IOError exception
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return None
     else:
-        logging.error(
-            'Type of ' + str(type(src_data))
-            + ' for the argument \'src_data\' is not supported.'
-        )
+        logger.error('Type of %s for the argument \'src_data\' is not '
+                     'supported.', type(src_data))
         return None
 
-    glacier = boto3.client('glacier')
+    glacier = get_glacier_client()
     try:
-        archive = glacier.upload_archive(vaultName=vault_name,
-                                         body=object_data)
+        parts = _read_parts(object_data)
+        first = next(parts)
+        second = next(parts, None)
+        if second is None:
+            archive = _upload_single(glacier, vault_name, first)
+        else:
+            archive = _upload_multipart(glacier, vault_name,
+                                        chain([first, second], parts))
     except ClientError as e:
-        logging.error(e)
+        logger.error(e)
         return None
     finally:
         if isinstance(src_data, str):
@@ -503,29 +642,490 @@ def test_upload_archive():
     # Alternatively, specify object contents using bytes.
     # filename = b'This is the data to store in the Glacier archive.'
 
-    # Set up logging
-    logging.basicConfig(level=logging.DEBUG,
-                        format=LOGGING_FORMAT)
-
     # Upload the archive
     archive = upload_archive(test_vault_name, filename)
     if archive is not None:
-        logging.info(
-            f'Archive {archive["archiveId"]} added to {test_vault_name}'
-        )
+        logger.info('Archive %s added to %s',
+                    archive['archiveId'], test_vault_name)
 
 
-def main():
-    test_create_vault()
-    test_delete_archive()
-    test_delete_vault()
-    test_describe_job()
-    test_list_vaults()
-    test_retrieve_inventory()
-    test_retrieve_inventory_results()
-    test_upload_archive()
-    test_backup_and_restore()
+def retrieve_archive(vault_name, archive_id):
+    """Initiate an Amazon Glacier archive-retrieval job
+    To check the status of the job, call Glacier.Client.describe_job()
+    To retrieve the output of the job, call retrieve_archive_results()
+    :param vault_name: string
+    :param archive_id: string
+    :return: Dictionary of information related to the initiated job. If error,
+    returns None.
+    """
 
+    # Construct job parameters
+    job_parms = {'Type': 'archive-retrieval', 'ArchiveId': archive_id}
 
-if __name__ == '__main__':
-    main()
+    # Initiate the job
+    glacier = get_glacier_client()
+    try:
+        response = glacier.initiate_job(vaultName=vault_name,
+                                        jobParameters=job_parms)
+    except ClientError as e:
+        logger.error(e)
+        return None
+    return response
+
+
+def retrieve_archive_results(vault_name, job_id, archive_id, pin=False):
+    """Retrieve the output of an Amazon Glacier archive-retrieval job into the
+    archive cache
+    :param vault_name: string
+    :param job_id: string. Job ID was returned by retrieve_archive()
+    :param archive_id: string. Archive ID the job was initiated for
+    :param pin: bool. If True, the cache entry is pinned and the caller must
+    call archive_cache.release(archive_id) once done with the path
+    :return: Path of the cached archive contents. If error, return None.
+    """
+
+    glacier = get_glacier_client()
+    for attempt in range(VERIFY_ATTEMPTS):
+        # Retrieve the job results
+        try:
+            response = glacier.get_job_output(vaultName=vault_name,
+                                              jobId=job_id)
+        except ClientError as e:
+            logger.error(e)
+            return None
+
+        # Stream the archive contents into the cache, checking the tree hash
+        # on the way; the output can be fetched again while the job is valid
+        expected = response.get('checksum')
+        hasher = TreeHasher()
+        with closing(response['body']) as body:
+            cached_path = archive_cache.put(
+                archive_id, HashingReader(body, hasher),
+                verify=lambda: expected in (None, hasher.hexdigest()),
+                pin=pin
+            )
+        if cached_path is not None:
+            return cached_path
+        logger.warning('Checksum mismatch retrieving %s; downloading again',
+                       archive_id)
+    logger.error('Archive %s failed verification %d times',
+                 archive_id, VERIFY_ATTEMPTS)
+    return None
+
+
+def restore_archive(vault_name, archive_id, dest_path, job_id=None):
+    """Restore an Amazon S3 Glacier archive to a local file.
+    The archive cache is checked first, so an archive that was retrieved
+    before does not need another retrieval job.
+    :param vault_name: string
+    :param archive_id: string
+    :param dest_path: string. Local file spec to write the archive to
+    :param job_id: string. Completed archive-retrieval job to read from. If
+    None and the archive is not cached, a new job is initiated.
+    :return: True if dest_path holds the archive, otherwise False
+    :return: String job ID of an initiated retrieval job, otherwise None.
+    Pass this string as the job_id argument once the job has completed.
+    """
+
+    # The miss was counted when the job was initiated; polling it again with
+    # --resume must not count another one
+    if (job_id is None or archive_id in archive_cache) and (
+        archive_cache.copy_to(archive_id, dest_path)
+    ):
+        logger.info('Restored archive %s from local cache', archive_id)
+        return True, None
+
+    if job_id is None:
+        response = retrieve_archive(vault_name, archive_id)
+        if response is None:
+            return False, None
+        logger.info('Initiated archive-retrieval job %s for %s',
+                    response['jobId'], archive_id)
+        return False, response['jobId']
+
+    cached_path = retrieve_archive_results(vault_name, job_id, archive_id,
+                                           pin=True)
+    if cached_path is None:
+        return False, job_id
+    try:
+        shutil.copyfile(cached_path, dest_path)
+    finally:
+        archive_cache.release(archive_id)
+    return True, None
+
+
+@contextmanager
+def download_to_cache(dbx, metadata):
+    """Fetch a Dropbox file into the archive cache unless already cached.
+    The entry cannot be evicted while the with block runs.
+    :param dbx: dropbox.Dropbox instance
+    :param metadata: files.FileMetadata of the file to fetch
+    :return: Context manager yielding the path of the cached file contents.
+    If error, or the download does not match metadata.content_hash, it
+    yields None.
+    """
+
+    with archive_cache.checkout(metadata.content_hash) as cached_path:
+        if cached_path is not None:
+            yield cached_path
+            return
+    cached_path = _download_verified(dbx, metadata)
+    try:
+        yield cached_path
+    finally:
+        if cached_path is not None:
+            archive_cache.release(metadata.content_hash)
+
+
+def _download_verified(dbx, metadata):
+    """Download a Dropbox file into a pinned cache entry, re-downloading
+    while its content_hash does not match"""
+    for attempt in range(VERIFY_ATTEMPTS):
+        try:
+            _, response = dbx.files_download(metadata.path_lower,
+                                             rev=metadata.rev)
+        except ApiError as e:
+            logger.error(e)
+            return None
+        hasher = ContentHasher()
+        with response:
+            cached_path = archive_cache.put(
+                metadata.content_hash, HashingReader(response.raw, hasher),
+                verify=lambda: hasher.hexdigest() == metadata.content_hash,
+                pin=True
+            )
+        if cached_path is not None:
+            return cached_path
+        logger.warning('Content hash mismatch downloading %s; '
+                       'downloading again', metadata.path_lower)
+    logger.error('%s failed verification %d times',
+                 metadata.path_lower, VERIFY_ATTEMPTS)
+    return None
+
+
+def transfer_to_glacier(dropbox_path, vault_name):
+    """Copy a Dropbox file into an Amazon S3 Glacier vault.
+    The file contents are read from the archive cache when present.
+    :param dropbox_path: string. Path of the file on Dropbox
+    :param vault_name: string
+    :return: If the file was added to vault, return dict of archive
+    information with the transferred 'size' in bytes, otherwise None
+    """
+
+    with dropbox.Dropbox(TOKEN) as dbx:
+        try:
+            metadata = dbx.files_get_metadata(dropbox_path)
+        except ApiError as e:
+            logger.error(e)
+            return None
+        with download_to_cache(dbx, metadata) as cached_path:
+            if cached_path is None:
+                return None
+            archive = upload_archive(vault_name, cached_path)
+    if archive is not None:
+        archive['size'] = metadata.size
+    return archive
+
+
+def load_mirror_state(state_path):
+    """Load the persisted state of mirror_to_glacier()
+    :param state_path: string. File spec of the state file
+    :return: Dictionary with the Dropbox list_folder 'cursor' (None before the
+    first listing), 'archives', mapping each mirrored Dropbox path to its
+    Glacier archiveId, content_hash and any 'superseded' archive IDs of
+    earlier versions not deleted yet, 'retry', the paths that failed to
+    mirror and are retried before the next long-poll, and 'relisting', True
+    while a full relist after a cursor reset is in progress
+    """
+
+    state = {'cursor': None, 'archives': {}, 'retry': [], 'relisting': False}
+    try:
+        with open(state_path, 'r') as f:
+            state.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    return state
+
+
+def save_mirror_state(state_path, state):
+    """Atomically persist the state of mirror_to_glacier()
+    :param state_path: string. File spec of the state file
+    :param state: Dictionary as returned by load_mirror_state()
+    """
+
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, state_path)
+
+
+def list_folder_changes(dbx, dropbox_path, cursor=None):
+    """Page through the entries of a recursive Dropbox folder listing
+    With a cursor, only entries changed since that cursor are listed.
+    :param dbx: dropbox.Dropbox instance
+    :param dropbox_path: string. Root of the listing ('' for the whole
+    Dropbox). Only used when cursor is None.
+    :param cursor: string. Cursor returned with a previous page
+    :return: Generator of (list of entries, cursor after those entries)
+    """
+
+    if cursor is None:
+        result = dbx.files_list_folder(dropbox_path, recursive=True)
+    else:
+        result = dbx.files_list_folder_continue(cursor)
+    yield result.entries, result.cursor
+    while result.has_more:
+        result = dbx.files_list_folder_continue(result.cursor)
+        yield result.entries, result.cursor
+
+
+def _delete_superseded(vault_name, archive):
+    """Delete the archives of earlier versions of a mirrored file, keeping
+    the IDs of any that fail in archive['superseded']
+    :return: True if none are left, otherwise False
+    """
+    remaining = [archive_id for archive_id in archive.pop('superseded', [])
+                 if not delete_archive(vault_name, archive_id)]
+    if remaining:
+        archive['superseded'] = remaining
+    return not remaining
+
+
+def mirror_entry(dbx, entry, vault_name, archives):
+    """Apply one changed Dropbox entry to an Amazon S3 Glacier vault
+    :param dbx: dropbox.Dropbox instance
+    :param entry: files.Metadata from a folder listing
+    :param vault_name: string
+    :param archives: Dictionary mapping mirrored Dropbox paths to archive
+    information, updated in place
+    :return: True if the entry was applied, otherwise False
+    """
+
+    path = entry.path_lower
+    if isinstance(entry, files.FileMetadata):
+        previous = archives.get(path)
+        if previous is None or previous['content_hash'] != entry.content_hash:
+            with download_to_cache(dbx, entry) as cached_path:
+                if cached_path is None:
+                    return False
+                archive = upload_archive(vault_name, cached_path)
+            if archive is None:
+                return False
+            superseded = []
+            if previous:
+                superseded = (previous.get('superseded', [])
+                              + [previous['archiveId']])
+            archives[path] = {'archiveId': archive['archiveId'],
+                              'content_hash': entry.content_hash,
+                              'superseded': superseded}
+            logger.info('Mirrored %s to archive %s', path,
+                        archive['archiveId'])
+        # Until the old versions are gone the entry is retried, so they are
+        # not left behind in the vault
+        return _delete_superseded(vault_name, archives[path])
+    elif isinstance(entry, files.DeletedMetadata):
+        # A deleted folder is reported once, without its children
+        removed = [p for p in archives
+                   if p == path or p.startswith(path + '/')]
+        for p in removed:
+            if not (
+                _delete_superseded(vault_name, archives[p])
+                and delete_archive(vault_name, archives[p]['archiveId'])
+            ):
+                return False
+            del archives[p]
+            logger.info('Removed mirror of %s', p)
+    return True
+
+
+def _is_cursor_reset(err):
+    """Return True if an ApiError reports that Dropbox invalidated a cursor"""
+    return (
+        isinstance(err.error, (files.ListFolderContinueError,
+                               files.ListFolderLongpollError))
+        and err.error.is_reset()
+    )
+
+
+def _mark_failed(state, path):
+    logger.error('Failed to mirror %s; will retry', path)
+    if path not in state['retry']:
+        state['retry'].append(path)
+
+
+def _mark_mirrored(state, path):
+    if path in state['retry']:
+        state['retry'].remove(path)
+
+
+def retry_failed_entries(dbx, vault_name, state):
+    """Mirror again the paths that failed earlier, from their current
+    Dropbox metadata
+    :param dbx: dropbox.Dropbox instance
+    :param vault_name: string
+    :param state: Dictionary as returned by load_mirror_state(), updated in
+    place
+    :return: True if every retried path was mirrored, otherwise False
+    """
+
+    for path in list(state['retry']):
+        try:
+            entry = dbx.files_get_metadata(path)
+        except ApiError as err:
+            if not (
+                err.error.is_path() and err.error.get_path().is_not_found()
+            ):
+                logger.error(err)
+                continue
+            # Gone since it failed; its mirror has to go as well
+            entry = files.DeletedMetadata(name=path.rsplit('/', 1)[-1],
+                                          path_lower=path)
+        if mirror_entry(dbx, entry, vault_name, state['archives']):
+            _mark_mirrored(state, path)
+    return not state['retry']
+
+
+def _prune_unlisted(vault_name, state, listed):
+    """Remove archives of paths a full relist did not return"""
+    for path in [p for p in state['archives'] if p not in listed]:
+        archive = state['archives'][path]
+        if (
+            _delete_superseded(vault_name, archive)
+            and delete_archive(vault_name, archive['archiveId'])
+        ):
+            del state['archives'][path]
+            logger.info('Removed mirror of %s', path)
+        else:
+            _mark_failed(state, path)
+
+
+def mirror_to_glacier(dropbox_path, vault_name, state_path,
+                      timeout=30, once=False):
+    """Continuously mirror a Dropbox folder into an Amazon S3 Glacier vault.
+    The first run lists the whole folder; afterwards the persisted cursor is
+    long-polled and only changed entries are transferred. Entries that fail
+    are kept in the state and retried before each long-poll. If Dropbox
+    resets the cursor, the folder is relisted and archives of paths that no
+    longer exist are removed.
+    :param dropbox_path: string. Folder to mirror ('' for the whole Dropbox)
+    :param vault_name: string
+    :param state_path: string. File spec where the cursor and the path to
+    archive mapping are persisted between pages and runs
+    :param timeout: int. Seconds (30 to 480) each long-poll waits for changes
+    :param once: bool. If True, return after catching up with the cursor
+    instead of waiting for further changes
+    :return: Dictionary of the mirror state
+    """
+
+    state = load_mirror_state(state_path)
+    with dropbox.Dropbox(TOKEN) as dbx:
+        while True:
+            try:
+                listed = set()
+                relisting = state['relisting']
+                for entries, cursor in list_folder_changes(
+                        dbx, dropbox_path,
+                        None if relisting else state['cursor']):
+                    for entry in entries:
+                        path = entry.path_lower
+                        if isinstance(entry, files.FileMetadata):
+                            listed.add(path)
+                        if mirror_entry(dbx, entry, vault_name,
+                                        state['archives']):
+                            _mark_mirrored(state, path)
+                        else:
+                            _mark_failed(state, path)
+                    # A relist is only checkpointed once complete, so an
+                    # interrupted one starts over and still sees every path
+                    if not relisting:
+                        state['cursor'] = cursor
+                    save_mirror_state(state_path, state)
+                if relisting:
+                    _prune_unlisted(vault_name, state, listed)
+                    state['relisting'] = False
+                    state['cursor'] = cursor
+                    save_mirror_state(state_path, state)
+
+                if state['retry']:
+                    retry_failed_entries(dbx, vault_name, state)
+                    save_mirror_state(state_path, state)
+
+                if once:
+                    return state
+
+                # Block until something changes under the cursor
+                result = dbx.files_list_folder_longpoll(state['cursor'],
+                                                        timeout=timeout)
+                if result.backoff:
+                    time.sleep(result.backoff)
+            except ApiError as err:
+                if not _is_cursor_reset(err):
+                    raise
+                # Unchanged files are skipped by their content_hash
+                logger.warning('Dropbox cursor was reset; relisting')
+                state['relisting'] = True
+                save_mirror_state(state_path, state)
+
+
+def scrub_mirror(state_path, sample_rate=0.01, requests_per_second=5,
+                 inventory=None):
+    """Check a random sample of mirrored files against the mirror state.
+    Dropbox metadata requests are spaced to stay under requests_per_second,
+    so a scrub can run alongside transfers. Drift is only reported: the state
+    file belongs to a running mirror_to_glacier(), which re-mirrors changed
+    files itself.
+    :param state_path: string. File spec of the mirror_to_glacier() state
+    :param sample_rate: float. Fraction of mirrored files to check
+    :param requests_per_second: float. Upper bound on Dropbox requests
+    :param inventory: Dictionary as returned by retrieve_inventory_results().
+    If given, the sampled archives are also checked for presence in the vault.
+    :return: Dictionary with the number of 'checked' files and lists of
+    'mismatched' and 'missing' Dropbox paths and of paths whose archive is
+    'unarchived'. A path that is no longer a file counts as mismatched.
+    """
+
+    state = load_mirror_state(state_path)
+    archive_ids = None
+    if inventory is not None:
+        archive_ids = {a['ArchiveId'] for a in inventory['ArchiveList']}
+    report = {'checked': 0, 'mismatched': [], 'missing': [],
+              'unarchived': []}
+    interval = 1.0 / requests_per_second
+    next_request = time.monotonic()
+
+    with dropbox.Dropbox(TOKEN) as dbx:
+        for path, archive in state['archives'].items():
+            if random.random() >= sample_rate:
+                continue
+            report['checked'] += 1
+            if archive_ids is not None and (
+                archive['archiveId'] not in archive_ids
+            ):
+                logger.warning('Archive for %s is not in the vault', path)
+                report['unarchived'].append(path)
+
+            delay = next_request - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_request = time.monotonic() + interval
+            try:
+                metadata = dbx.files_get_metadata(path)
+            except ApiError as err:
+                if (
+                    err.error.is_path()
+                    and err.error.get_path().is_not_found()
+                ):
+                    report['missing'].append(path)
+                else:
+                    logger.error(err)
+                continue
+
+            if (
+                not isinstance(metadata, files.FileMetadata)
+                or metadata.content_hash != archive['content_hash']
+            ):
+                logger.warning('%s does not match its mirrored archive', path)
+                report['mismatched'].append(path)
+    return report
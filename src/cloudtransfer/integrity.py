@@ -0,0 +1,115 @@
+import hashlib
+
+
+# Glacier tree hashes are built from SHA-256 digests of 1 MiB leaves
+TREE_HASH_CHUNK_SIZE = 1024 * 1024
+
+# Dropbox content hashes are built from SHA-256 digests of 4 MiB blocks
+CONTENT_HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def tree_hash_from_leaves(leaves):
+    """Combine SHA-256 leaf digests into an Amazon S3 Glacier tree hash
+    :param leaves: List of binary SHA-256 digests of consecutive 1 MiB chunks
+    :return: Hex string of the tree hash
+    """
+
+    if not leaves:
+        return hashlib.sha256(b'').hexdigest()
+    level = list(leaves)
+    while len(level) > 1:
+        combined = []
+        for i in range(0, len(level) - 1, 2):
+            combined.append(hashlib.sha256(level[i] + level[i + 1]).digest())
+        if len(level) % 2:
+            # An odd digest out is promoted to the next level unchanged
+            combined.append(level[-1])
+        level = combined
+    return level[0].hex()
+
+
+class _BlockHasher:
+    """Feed data in arbitrary pieces and hash it in fixed-size blocks"""
+
+    block_size = None
+
+    def __init__(self):
+        self.blocks = []
+        self._current = hashlib.sha256()
+        self._current_size = 0
+        self.size = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        self.size += len(view)
+        while view:
+            take = min(len(view), self.block_size - self._current_size)
+            self._current.update(view[:take])
+            self._current_size += take
+            view = view[take:]
+            if self._current_size == self.block_size:
+                self.blocks.append(self._current.digest())
+                self._current = hashlib.sha256()
+                self._current_size = 0
+
+    def _all_blocks(self):
+        if self._current_size:
+            return self.blocks + [self._current.digest()]
+        return self.blocks
+
+
+class TreeHasher(_BlockHasher):
+    """Incremental Amazon S3 Glacier SHA-256 tree hash, as returned in the
+    'checksum' of upload and job output responses"""
+
+    block_size = TREE_HASH_CHUNK_SIZE
+
+    @property
+    def leaves(self):
+        """Leaf digests so far, for combining parts into a whole archive"""
+        return self._all_blocks()
+
+    def hexdigest(self):
+        return tree_hash_from_leaves(self._all_blocks())
+
+
+class ContentHasher(_BlockHasher):
+    """Incremental Dropbox content_hash"""
+
+    block_size = CONTENT_HASH_BLOCK_SIZE
+
+    def hexdigest(self):
+        return hashlib.sha256(b''.join(self._all_blocks())).hexdigest()
+
+
+class HashingReader:
+    """Readable file wrapper that hashes the data as it is read, so the
+    contents are verified in the same pass that transfers them"""
+
+    def __init__(self, fileobj, *hashers):
+        """
+        :param fileobj: Readable binary file object
+        :param hashers: Objects with an update(data) method, e.g. TreeHasher
+        """
+        self.fileobj = fileobj
+        self.hashers = hashers
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        for hasher in self.hashers:
+            hasher.update(data)
+        return data
+
+
+def tree_hash(data):
+    """Return the Amazon S3 Glacier tree hash of bytes"""
+    hasher = TreeHasher()
+    hasher.update(data)
+    return hasher.hexdigest()
+
+
+def content_hash(data):
+    """Return the Dropbox content_hash of bytes"""
+    hasher = ContentHasher()
+    hasher.update(data)
+    return hasher.hexdigest()
@@ -0,0 +1,117 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+
+LOGGING_FORMAT = '%(levelname)s: %(asctime)s: %(message)s'
+
+_listener = None
+
+
+class RateLimitFilter(logging.Filter):
+    """Rate limit records per event, keyed by logger and message template.
+    Each event may burst up to `burst` records and is then sampled down to
+    `rate` records per second. Records at or above `level` always pass. The
+    next record let through carries the number suppressed in its `suppressed`
+    attribute, which SuppressedCountFormatter appends to the message.
+    """
+
+    def __init__(self, rate=10.0, burst=None, level=logging.WARNING,
+                 clock=time.monotonic):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1)
+        self.level = level
+        self.clock = clock
+        self._buckets = {}  # event -> [tokens, last update, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= self.level:
+            return True
+        # The message may be any object, e.g. a dict, so key on its text
+        event = (record.name, str(record.msg))
+        now = self.clock()
+        with self._lock:
+            bucket = self._buckets.get(event)
+            if bucket is None:
+                bucket = self._buckets[event] = [self.burst, now, 0]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                bucket[2] += 1
+                return False
+            bucket[0] = tokens - 1
+            suppressed, bucket[2] = bucket[2], 0
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class SuppressedCountFormatter(logging.Formatter):
+    """Formatter appending the count RateLimitFilter stores in a record's
+    `suppressed` attribute to the message"""
+
+    def formatMessage(self, record):
+        # format() sets record.message afresh on every call
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            record.message += f' ({suppressed} similar messages suppressed)'
+        return super().formatMessage(record)
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """Queue records unformatted, so messages are only formatted on the
+    listener thread. Objects passed as logging arguments must therefore not
+    be mutated after the call."""
+
+    def prepare(self, record):
+        return record
+
+
+def configure_logging(level=logging.WARNING, stream=None,
+                      fmt=LOGGING_FORMAT, rate=10.0):
+    """Route all logging through a queue drained by a background thread.
+    Call once at program start; the cloudtransfer CLI does. Calling again
+    replaces the previous configuration.
+    :param level: Root logger level
+    :param stream: Stream the listener writes to, defaults to sys.stderr
+    :param fmt: Format string for the records
+    :param rate: float. Records per second allowed for each event below
+    WARNING, see RateLimitFilter
+    :return: The running logging.handlers.QueueListener
+    """
+
+    global _listener
+    stop_logging()
+
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(SuppressedCountFormatter(fmt))
+    log_queue = queue.Queue()
+    queue_handler = _DeferredQueueHandler(log_queue)
+    # Filter before enqueueing, so dropped records cost no queue traffic
+    queue_handler.addFilter(RateLimitFilter(rate))
+
+    root = logging.getLogger()
+    for old_handler in root.handlers[:]:
+        root.removeHandler(old_handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _listener = QueueListener(log_queue, handler)
+    _listener.start()
+    return _listener
+
+
+@atexit.register
+def stop_logging():
+    """Flush queued records and stop the background thread. Registered to
+    run when the interpreter exits."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
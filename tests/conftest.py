@@ -0,0 +1,261 @@
+import io
+import json
+from types import SimpleNamespace
+
+import pytest
+from botocore.exceptions import ClientError
+from dropbox import files
+from dropbox.exceptions import ApiError
+
+from cloudtransfer.cache import ArchiveCache
+from cloudtransfer.integrity import content_hash, tree_hash
+
+
+class StopTest(Exception):
+    """Raised by fakes to end an otherwise endless loop"""
+
+
+def client_error(code, operation):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+
+def corrupt(data):
+    return bytes([data[0] ^ 0xff]) + data[1:] if data else b'\0'
+
+
+def file_metadata(path, data):
+    return files.FileMetadata(name=path.rsplit('/', 1)[-1], path_lower=path,
+                              content_hash=content_hash(data),
+                              rev='0123456789', size=len(data))
+
+
+def folder_metadata(path):
+    return files.FolderMetadata(name=path.rsplit('/', 1)[-1], path_lower=path)
+
+
+def deleted_metadata(path):
+    return files.DeletedMetadata(name=path.rsplit('/', 1)[-1],
+                                 path_lower=path)
+
+
+def page(entries, cursor, has_more=False):
+    return files.ListFolderResult(entries=entries, cursor=cursor,
+                                  has_more=has_more)
+
+
+def not_found():
+    error = files.GetMetadataError.path(files.LookupError.not_found)
+    return ApiError('request-id', error, None, None)
+
+
+def cursor_reset(error_type=files.ListFolderContinueError):
+    return ApiError('request-id', error_type.reset, None, None)
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.raw = io.BytesIO(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.raw.close()
+
+
+class FakeDropbox:
+    """Dropbox client over an in-memory dict of path -> bytes. Listing and
+    long-poll results are scripted; exceptions in the scripts are raised."""
+
+    def __init__(self):
+        self.files = {}
+        self.pages = []
+        self.longpolls = []
+        self.calls = []
+        self.corrupt_downloads = 0
+        self.corrupt_uploads = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def _next(self, script):
+        result = script.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def files_list_folder(self, path, recursive=False):
+        self.calls.append(('list', path))
+        return self._next(self.pages)
+
+    def files_list_folder_continue(self, cursor):
+        self.calls.append(('continue', cursor))
+        return self._next(self.pages)
+
+    def files_list_folder_longpoll(self, cursor, timeout=30):
+        self.calls.append(('longpoll', cursor))
+        return self._next(self.longpolls)
+
+    def files_get_metadata(self, path):
+        self.calls.append(('get_metadata', path))
+        if path not in self.files:
+            raise not_found()
+        if self.files[path] is None:
+            return folder_metadata(path)
+        return file_metadata(path, self.files[path])
+
+    def files_download(self, path, rev=None):
+        self.calls.append(('download', path))
+        data = self.files[path]
+        metadata = file_metadata(path, data)
+        if self.corrupt_downloads:
+            self.corrupt_downloads -= 1
+            data = corrupt(data)
+        return metadata, FakeResponse(data)
+
+    def files_restore(self, path, rev):
+        self.calls.append(('restore', path))
+        return file_metadata(path, self.files[path])
+
+    def files_upload(self, data, path, mode=None):
+        self.calls.append(('upload', path))
+        if self.corrupt_uploads:
+            self.corrupt_uploads -= 1
+            data = corrupt(data)
+        self.files[path] = data
+        return file_metadata(path, data)
+
+
+class FakeGlacier:
+    """Glacier client over in-memory archives. Like Glacier, it rejects a
+    body whose tree hash does not match the checksum sent with it.
+
+    corrupt maps 'single', a part's byte range or a job ID to the number of
+    times its data is damaged in transit; unavailable maps an operation name
+    to the number of times it fails with a throttling error.
+    """
+
+    def __init__(self):
+        self.archives = {}
+        self.uploads = {}
+        self.jobs = {}
+        self.running_jobs = set()
+        self.corrupt = {}
+        self.unavailable = {}
+        self.part_calls = []
+        self.aborted = []
+        self.deleted = []
+        self._ids = 0
+
+    def _new_id(self, prefix):
+        self._ids += 1
+        return f'{prefix}-{self._ids}'
+
+    def _take(self, counts, key):
+        if counts.get(key):
+            counts[key] -= 1
+            return True
+        return False
+
+    def _receive(self, operation, key, body, checksum):
+        if self._take(self.unavailable, operation):
+            raise client_error('ThrottlingException', operation)
+        if self._take(self.corrupt, key):
+            body = corrupt(body)
+        if tree_hash(body) != checksum:
+            raise client_error('InvalidParameterValueException', operation)
+        return body
+
+    def upload_archive(self, vaultName, body, checksum):
+        body = self._receive('UploadArchive', 'single', body, checksum)
+        archive_id = self._new_id('archive')
+        self.archives[archive_id] = body
+        return {'archiveId': archive_id, 'checksum': checksum,
+                'location': f'/-/vaults/{vaultName}/archives/{archive_id}'}
+
+    def initiate_multipart_upload(self, vaultName, partSize):
+        upload_id = self._new_id('upload')
+        self.uploads[upload_id] = {}
+        return {'uploadId': upload_id}
+
+    def upload_multipart_part(self, vaultName, uploadId, range, checksum,
+                              body):
+        self.part_calls.append(range)
+        body = self._receive('UploadMultipartPart', range, body, checksum)
+        start = int(range.split()[1].split('-')[0])
+        self.uploads[uploadId][start] = body
+        return {'checksum': checksum}
+
+    def complete_multipart_upload(self, vaultName, uploadId, archiveSize,
+                                  checksum):
+        parts = self.uploads.pop(uploadId)
+        body = b''.join(parts[start] for start in sorted(parts))
+        if len(body) != int(archiveSize) or tree_hash(body) != checksum:
+            raise client_error('InvalidParameterValueException',
+                               'CompleteMultipartUpload')
+        archive_id = self._new_id('archive')
+        self.archives[archive_id] = body
+        return {'archiveId': archive_id, 'checksum': checksum,
+                'location': f'/-/vaults/{vaultName}/archives/{archive_id}'}
+
+    def abort_multipart_upload(self, vaultName, uploadId):
+        self.aborted.append(uploadId)
+        self.uploads.pop(uploadId, None)
+
+    def delete_archive(self, vaultName, archiveId):
+        if self._take(self.unavailable, 'DeleteArchive'):
+            raise client_error('ThrottlingException', 'DeleteArchive')
+        if archiveId not in self.archives:
+            raise client_error('ResourceNotFoundException', 'DeleteArchive')
+        del self.archives[archiveId]
+        self.deleted.append(archiveId)
+        return {'ResponseMetadata': {'HTTPStatusCode': 204}}
+
+    def initiate_job(self, vaultName, jobParameters):
+        job_id = self._new_id('job')
+        self.jobs[job_id] = jobParameters
+        return {'jobId': job_id}
+
+    def describe_job(self, vaultName, jobId):
+        if jobId not in self.jobs:
+            raise client_error('ResourceNotFoundException', 'DescribeJob')
+        completed = jobId not in self.running_jobs
+        return {'JobId': jobId, 'Action': self.jobs[jobId]['Type'],
+                'Completed': completed,
+                'StatusCode': 'Succeeded' if completed else 'InProgress'}
+
+    def get_job_output(self, vaultName, jobId):
+        if jobId in self.running_jobs or self._take(self.unavailable, jobId):
+            raise client_error('InvalidParameterValueException',
+                               'GetJobOutput')
+        if self.jobs[jobId]['Type'] == 'inventory-retrieval':
+            inventory = {'VaultARN': f'arn:aws:glacier:::vaults/{vaultName}',
+                         'ArchiveList': [{'ArchiveId': archive_id,
+                                          'Size': len(data)}
+                                         for archive_id, data
+                                         in self.archives.items()]}
+            return {'body': io.BytesIO(json.dumps(inventory).encode())}
+        data = self.archives[self.jobs[jobId]['ArchiveId']]
+        checksum = tree_hash(data)
+        if self._take(self.corrupt, jobId):
+            data = corrupt(data)
+        return {'body': io.BytesIO(data), 'checksum': checksum}
+
+
+@pytest.fixture
+def ct(monkeypatch, tmp_path):
+    """cloudtransfer.cloudtransfer wired to a fake Glacier, a fake Dropbox
+    and an archive cache under tmp_path"""
+    from cloudtransfer import cloudtransfer
+
+    glacier = FakeGlacier()
+    dbx = FakeDropbox()
+    cache = ArchiveCache(str(tmp_path / 'cache'), 1 << 30)
+    monkeypatch.setattr(cloudtransfer, 'archive_cache', cache)
+    monkeypatch.setattr(cloudtransfer, '_glacier_client', glacier)
+    monkeypatch.setattr(cloudtransfer.dropbox, 'Dropbox', lambda token: dbx)
+    return SimpleNamespace(module=cloudtransfer, glacier=glacier, dbx=dbx,
+                           cache=cache, tmp_path=tmp_path)
@@ -0,0 +1,64 @@
+import io
+import json
+
+from cloudtransfer.batch import load_results, read_manifest, run_batch
+
+
+MANIFEST = [
+    '{"op": "upload", "path": "a"}\n',
+    'not json\n',
+    '\n',
+    '{"id": "b", "op": "upload", "path": "b"}\n',
+    '{"op": "retrieve"}\n',
+]
+
+
+def handler(item):
+    if item['op'] == 'retrieve':
+        if 'job_id' in item:
+            return {'bytes': 3}
+        return {'pending': True, 'job_id': 'JOB'}
+    return {'bytes': len(item['path'])}
+
+
+def run(**kwargs):
+    output = io.StringIO()
+    summary = run_batch(read_manifest(MANIFEST), handler, output,
+                        concurrency=2, **kwargs)
+    results = [json.loads(line) for line in output.getvalue().splitlines()]
+    return summary, {result['id']: result for result in results}
+
+
+def test_run_batch():
+    summary, results = run()
+    assert results[1]['status'] == 'ok'
+    assert results[2]['status'] == 'failed'
+    assert results['b']['result'] == {'bytes': 1}
+    assert results[5] == dict(results[5], status='pending',
+                              result={'job_id': 'JOB'})
+    assert (summary['ok'], summary['failed'], summary['pending']) == (2, 1, 1)
+    assert summary['bytes'] == 2
+
+
+def test_dry_run_validates():
+    def validate(item):
+        if item['op'] != 'upload':
+            raise ValueError('Unknown operation')
+
+    summary, results = run(dry_run=True, validate=validate)
+    assert summary['dry-run'] == 2
+    assert results[5]['error'] == 'Unknown operation'
+
+
+def test_resume(tmp_path):
+    _, first = run()
+    results_path = str(tmp_path / 'results.jsonl')
+    with open(results_path, 'w') as f:
+        for result in first.values():
+            f.write(json.dumps(result) + '\n')
+        f.write('{"id": 1, "trunc')
+
+    summary, results = run(previous=load_results(results_path))
+    assert summary['skipped'] == 2
+    assert results[5]['status'] == 'ok'
+    assert summary['bytes'] == 3
@@ -0,0 +1,75 @@
+import io
+import os
+import time
+
+from cloudtransfer.cache import STALE_TMP_AGE, ArchiveCache
+
+
+def test_put_and_get(tmp_path):
+    cache = ArchiveCache(str(tmp_path), 1024)
+    assert cache.get('archive') is None
+    cache.put('archive', b'contents')
+    path = cache.get('archive')
+    with open(path, 'rb') as f:
+        assert f.read() == b'contents'
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'bytes_saved': 8,
+                             'entries': 1, 'size': 8}
+
+
+def test_lru_eviction(tmp_path):
+    cache = ArchiveCache(str(tmp_path), 10)
+    cache.put('a', b'1234')
+    cache.put('b', io.BytesIO(b'1234'))
+    cache.get('a')
+    cache.put('c', b'1234')
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert 'c' in cache
+    assert cache.stats()['size'] == 8
+
+
+def test_index_survives_restart(tmp_path):
+    ArchiveCache(str(tmp_path), 1024).put('archive', b'contents')
+    stale = os.path.join(str(tmp_path), 'stale.tmp')
+    fresh = os.path.join(str(tmp_path), 'fresh.tmp')
+    open(stale, 'wb').close()
+    open(fresh, 'wb').close()
+    old = time.time() - STALE_TMP_AGE - 1
+    os.utime(stale, (old, old))
+    cache = ArchiveCache(str(tmp_path), 1024)
+    assert cache.copy_to('archive', str(tmp_path / 'out'))
+    assert (tmp_path / 'out').read_bytes() == b'contents'
+    assert not os.path.exists(stale)
+    # May be another process's insertion in progress
+    assert os.path.exists(fresh)
+
+
+def test_checkout_pins_entry(tmp_path):
+    cache = ArchiveCache(str(tmp_path), 10)
+    cache.put('a', b'1234')
+    cache.put('b', b'1234')
+    with cache.checkout('a') as path:
+        cache.put('c', b'12345678')
+        assert os.path.exists(path)
+        assert 'a' in cache
+        assert 'b' not in cache
+        assert cache.stats()['size'] == 12
+    # Evicted once released, as the cache is over its cap
+    assert 'a' not in cache
+    assert cache.stats()['size'] == 8
+
+
+def test_put_pin(tmp_path):
+    cache = ArchiveCache(str(tmp_path), 4)
+    path = cache.put('a', b'1234', pin=True)
+    cache.put('b', b'1234')
+    assert os.path.exists(path)
+    cache.release('a')
+    assert 'a' not in cache
+
+
+def test_put_verify_failure(tmp_path):
+    cache = ArchiveCache(str(tmp_path), 1024)
+    assert cache.put('archive', b'contents', verify=lambda: False) is None
+    assert 'archive' not in cache
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,128 @@
+import json
+
+import pytest
+
+from cloudtransfer import cli
+
+
+@pytest.fixture
+def run(ct, monkeypatch, capsys):
+    """Run the CLI on a list of manifest items; return the exit status,
+    the results by id and the summary"""
+    monkeypatch.setattr(cli, 'configure_logging', lambda **kwargs: None)
+    manifest = ct.tmp_path / 'manifest.jsonl'
+    output = ct.tmp_path / 'results.jsonl'
+
+    def run(items, *args):
+        manifest.write_text(''.join(json.dumps(i) + '\n' for i in items))
+        status = cli.main([str(manifest), '--output', str(output)]
+                          + list(args))
+        results = {}
+        for line in output.read_text().splitlines():
+            result = json.loads(line)
+            results[result['id']] = result
+        summary = json.loads(capsys.readouterr().err.splitlines()[-1])
+        return status, results, summary
+    return run
+
+
+def test_validate_item():
+    cli.validate_item({'op': 'delete', 'vault': 'v', 'archive_id': 'a'})
+    with pytest.raises(ValueError, match='Unknown operation'):
+        cli.validate_item({'op': 'copy'})
+    with pytest.raises(ValueError, match='missing vault, path'):
+        cli.validate_item({'op': 'upload'})
+
+
+def test_resume_requires_output(capsys):
+    with pytest.raises(SystemExit) as exc_info:
+        cli.main(['manifest.jsonl', '--resume'])
+    assert exc_info.value.code == 2
+    assert '--resume requires --output' in capsys.readouterr().err
+
+
+def test_operations(ct, run):
+    local = ct.tmp_path / 'local.bin'
+    local.write_bytes(b'local data')
+    ct.dbx.files['/remote.bin'] = b'remote data!'
+    old = ct.glacier.upload_archive('vault', b'old',
+                                    ct.module.tree_hash(b'old'))
+
+    status, results, summary = run([
+        {'id': 'up', 'op': 'upload', 'vault': 'vault', 'path': str(local)},
+        {'id': 'xfer', 'op': 'transfer', 'vault': 'vault',
+         'source': '/remote.bin'},
+        {'id': 'del', 'op': 'delete', 'vault': 'vault',
+         'archive_id': old['archiveId']},
+    ])
+    assert status == 0
+    assert {r['status'] for r in results.values()} == {'ok'}
+    assert ct.glacier.archives[results['xfer']['result']['archiveId']] == (
+        b'remote data!'
+    )
+    assert old['archiveId'] not in ct.glacier.archives
+    # Cross-cloud transfers count towards throughput
+    assert results['xfer']['result']['bytes'] == 12
+    assert summary['bytes'] == 22
+
+
+def test_failure_sets_exit_status(ct, run):
+    status, results, summary = run([
+        {'id': 'del', 'op': 'delete', 'vault': 'vault', 'archive_id': 'x'},
+        {'id': 'bad', 'op': 'copy'},
+    ])
+    assert status == 1
+    assert results['del']['status'] == 'failed'
+    assert results['bad']['error'] == "Unknown operation 'copy'"
+    assert summary['failed'] == 2
+
+
+def test_dry_run(ct, run):
+    status, results, _ = run([{'id': 'del', 'op': 'delete', 'vault': 'v',
+                               'archive_id': 'x'}], '--dry-run')
+    assert status == 0
+    assert results['del']['status'] == 'dry-run'
+    assert ct.glacier.deleted == []
+
+
+def test_inventory_resume_keeps_unfinished_job(ct, run):
+    dest = ct.tmp_path / 'inventory.json'
+    items = [{'id': 'inv', 'op': 'inventory', 'vault': 'vault',
+              'dest': str(dest)}]
+    _, results, _ = run(items)
+    job_id = results['inv']['result']['job_id']
+    assert results['inv']['status'] == 'pending'
+
+    ct.glacier.running_jobs.add(job_id)
+    _, results, _ = run(items, '--resume')
+    assert results['inv'] == dict(results['inv'], status='pending',
+                                  result={'job_id': job_id})
+    assert list(ct.glacier.jobs) == [job_id]
+
+    ct.glacier.running_jobs.clear()
+    status, results, _ = run(items, '--resume')
+    assert status == 0
+    assert results['inv']['status'] == 'ok'
+    assert json.loads(dest.read_text())['ArchiveList'] == []
+    assert list(ct.glacier.jobs) == [job_id]
+
+
+def test_download_resume(ct, run):
+    archive = ct.glacier.upload_archive('vault', b'archived',
+                                        ct.module.tree_hash(b'archived'))
+    dest = ct.tmp_path / 'restored.bin'
+    items = [{'id': 'get', 'op': 'download', 'vault': 'vault',
+              'archive_id': archive['archiveId'], 'dest': str(dest)}]
+    _, results, _ = run(items)
+    job_id = results['get']['result']['job_id']
+
+    ct.glacier.running_jobs.add(job_id)
+    _, results, _ = run(items, '--resume')
+    assert results['get']['result'] == {'job_id': job_id}
+
+    ct.glacier.running_jobs.clear()
+    _, results, summary = run(items, '--resume')
+    assert results['get']['status'] == 'ok'
+    assert dest.read_bytes() == b'archived'
+    assert summary['bytes'] == 8
+    assert list(ct.glacier.jobs) == [job_id]
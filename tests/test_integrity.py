@@ -0,0 +1,48 @@
+import hashlib
+import io
+
+from cloudtransfer.integrity import (
+    ContentHasher, HashingReader, TreeHasher, content_hash, tree_hash,
+    tree_hash_from_leaves
+)
+
+MIB = 1024 * 1024
+
+
+def sha256(data):
+    return hashlib.sha256(data).digest()
+
+
+def test_tree_hash():
+    assert tree_hash(b'') == hashlib.sha256(b'').hexdigest()
+    assert tree_hash(b'abc') == hashlib.sha256(b'abc').hexdigest()
+    data = b'a' * MIB + b'b' * MIB + b'c'
+    leaves = [sha256(b'a' * MIB), sha256(b'b' * MIB), sha256(b'c')]
+    assert tree_hash(data) == sha256(
+        sha256(leaves[0] + leaves[1]) + leaves[2]
+    ).hex()
+
+
+def test_tree_hash_of_parts():
+    data = bytes(range(256)) * (5 * MIB // 256)
+    whole = []
+    for offset in range(0, len(data), 2 * MIB):
+        part = TreeHasher()
+        part.update(data[offset:offset + 2 * MIB])
+        whole.extend(part.leaves)
+    assert tree_hash_from_leaves(whole) == tree_hash(data)
+
+
+def test_content_hash():
+    data = b'x' * (4 * MIB + 10)
+    expected = sha256(sha256(data[:4 * MIB]) + sha256(data[4 * MIB:]))
+    assert content_hash(data) == expected.hex()
+
+
+def test_hashing_reader():
+    data = b'y' * (3 * MIB)
+    hasher = ContentHasher()
+    reader = HashingReader(io.BytesIO(data), hasher)
+    while reader.read(12345):
+        pass
+    assert hasher.hexdigest() == content_hash(data)
@@ -0,0 +1,72 @@
+import io
+import logging
+
+import pytest
+
+from cloudtransfer.log import (
+    RateLimitFilter, SuppressedCountFormatter, configure_logging, stop_logging
+)
+
+
+def record(msg, *args, level=logging.INFO):
+    return logging.LogRecord('cloudtransfer', level, __file__, 1, msg, args,
+                             None)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_rate_limit_per_event():
+    limiter = RateLimitFilter(rate=0.001, burst=2)
+    passed = [limiter.filter(record('Archive %s', i)) for i in range(5)]
+    assert passed == [True, True, False, False, False]
+    # Other events and warnings are unaffected
+    assert limiter.filter(record('Vault %s', 'v'))
+    assert limiter.filter(record('Archive %s', 5, level=logging.WARNING))
+
+
+def test_rate_limit_unhashable_message():
+    limiter = RateLimitFilter(rate=0.001, burst=1)
+    assert limiter.filter(record({'archiveId': 'a'}))
+    assert not limiter.filter(record({'archiveId': 'a'}))
+
+
+def test_suppressed_count_reported():
+    clock = Clock()
+    limiter = RateLimitFilter(rate=1, burst=1, clock=clock)
+    assert limiter.filter(record('Archive %s', 1))
+    assert not limiter.filter(record('Archive %s', 2))
+    assert not limiter.filter(record('Archive %s', 3))
+    clock.now += 1
+    late = record('Archive %s', 4)
+    assert limiter.filter(late)
+    # The message itself is left for the formatter
+    assert late.getMessage() == 'Archive 4'
+    assert late.suppressed == 2
+    formatter = SuppressedCountFormatter('%(levelname)s %(message)s')
+    assert (formatter.format(late)
+            == 'INFO Archive 4 (2 similar messages suppressed)')
+    assert formatter.format(record('Archive %s', 5)) == 'INFO Archive 5'
+
+
+@pytest.fixture
+def root_logger():
+    root = logging.getLogger()
+    level, handlers = root.level, root.handlers[:]
+    yield root
+    stop_logging()
+    root.handlers[:] = handlers
+    root.setLevel(level)
+
+
+def test_configure_logging(root_logger):
+    stream = io.StringIO()
+    configure_logging(level=logging.INFO, stream=stream, fmt='%(message)s')
+    logging.getLogger('cloudtransfer.test').info('Mirrored %s', 'a')
+    stop_logging()
+    assert stream.getvalue() == 'Mirrored a\n'
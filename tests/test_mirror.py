@@ -0,0 +1,181 @@
+import json
+
+import pytest
+from dropbox import files
+
+from .conftest import (
+    StopTest, cursor_reset, deleted_metadata, file_metadata, page
+)
+
+
+def test_list_folder_changes_pages(ct):
+    a = file_metadata('/a', b'a')
+    b = file_metadata('/b', b'b')
+    ct.dbx.pages = [page([a], 'c1', has_more=True), page([b], 'c2')]
+    assert list(ct.module.list_folder_changes(ct.dbx, '/root')) == [
+        ([a], 'c1'), ([b], 'c2')
+    ]
+    assert ct.dbx.calls == [('list', '/root'), ('continue', 'c1')]
+
+    ct.dbx.pages = [page([], 'c3')]
+    assert list(ct.module.list_folder_changes(ct.dbx, '/root', 'c2')) == [
+        ([], 'c3')
+    ]
+    assert ct.dbx.calls[-1] == ('continue', 'c2')
+
+
+def mirror(ct, path, data, archives):
+    ct.dbx.files[path] = data
+    return ct.module.mirror_entry(ct.dbx, file_metadata(path, data), 'vault',
+                                  archives)
+
+
+def test_mirror_entry_replaces_changed_file(ct):
+    archives = {}
+    assert mirror(ct, '/a', b'one', archives)
+    first = archives['/a']['archiveId']
+    assert ct.glacier.archives[first] == b'one'
+
+    # Unchanged content is neither downloaded nor uploaded again
+    downloads = ct.dbx.calls.count(('download', '/a'))
+    assert mirror(ct, '/a', b'one', archives)
+    assert archives['/a']['archiveId'] == first
+    assert ct.dbx.calls.count(('download', '/a')) == downloads
+
+    assert mirror(ct, '/a', b'two', archives)
+    second = archives['/a']['archiveId']
+    assert ct.glacier.archives[second] == b'two'
+    assert first not in ct.glacier.archives
+
+
+def test_mirror_entry_retries_superseded_archive(ct):
+    archives = {}
+    assert mirror(ct, '/a', b'one', archives)
+    first = archives['/a']['archiveId']
+
+    # The new version is mirrored, but the old archive is kept for deletion
+    ct.glacier.unavailable['DeleteArchive'] = 1
+    assert not mirror(ct, '/a', b'two', archives)
+    second = archives['/a']['archiveId']
+    assert archives['/a']['superseded'] == [first]
+    assert first in ct.glacier.archives
+
+    # Retrying deletes it without uploading the new version again
+    assert mirror(ct, '/a', b'two', archives)
+    assert archives['/a'] == {'archiveId': second,
+                              'content_hash': file_metadata('/a', b'two')
+                              .content_hash}
+    assert set(ct.glacier.archives) == {second}
+
+    # A deleted path takes its superseded archives with it
+    ct.glacier.unavailable['DeleteArchive'] = 1
+    assert not mirror(ct, '/a', b'three', archives)
+    assert ct.module.mirror_entry(ct.dbx, deleted_metadata('/a'), 'vault',
+                                  archives)
+    assert archives == {}
+    assert ct.glacier.archives == {}
+
+
+def test_mirror_entry_deletes_folder_and_children(ct):
+    archives = {}
+    for path in ('/dir/a', '/dir/sub/b', '/dirx/c'):
+        assert mirror(ct, path, path.encode(), archives)
+    assert ct.module.mirror_entry(ct.dbx, deleted_metadata('/dir'), 'vault',
+                                  archives)
+    assert list(archives) == ['/dirx/c']
+    assert len(ct.glacier.archives) == 1
+
+
+def test_mirror_retries_failed_entries(ct):
+    state_path = str(ct.tmp_path / 'state.json')
+    ct.dbx.files = {'/a': b'a', '/b': b'b'}
+    ct.dbx.pages = [page([file_metadata('/a', b'a'),
+                          file_metadata('/b', b'b')], 'c1')]
+    # A transient failure is retried before the run waits for changes
+    ct.glacier.unavailable['UploadArchive'] = 1
+
+    state = ct.module.mirror_to_glacier('', 'vault', state_path, once=True)
+    assert state['cursor'] == 'c1'
+    assert state['retry'] == []
+    assert sorted(state['archives']) == ['/a', '/b']
+
+    # A failure that outlasts the run is persisted for the next one
+    ct.dbx.files['/c'] = b'c'
+    ct.dbx.pages = [page([file_metadata('/c', b'c')], 'c2')]
+    ct.glacier.unavailable['UploadArchive'] = 100
+    state = ct.module.mirror_to_glacier('', 'vault', state_path, once=True)
+    with open(state_path) as f:
+        saved = json.load(f)
+    assert saved['cursor'] == 'c2'
+    assert saved['retry'] == ['/c']
+    assert '/c' not in saved['archives']
+
+    ct.glacier.unavailable['UploadArchive'] = 0
+    ct.dbx.pages = [page([], 'c3')]
+    state = ct.module.mirror_to_glacier('', 'vault', state_path, once=True)
+    assert state['retry'] == []
+    assert '/c' in state['archives']
+    assert ('continue', 'c2') in ct.dbx.calls
+
+
+def test_mirror_retry_of_deleted_path(ct):
+    state_path = str(ct.tmp_path / 'state.json')
+    ct.dbx.pages = [page([], 'c1')]
+    with open(state_path, 'w') as f:
+        json.dump({'cursor': 'c0', 'archives': {}, 'retry': ['/gone']}, f)
+    state = ct.module.mirror_to_glacier('', 'vault', state_path, once=True)
+    assert state['retry'] == []
+
+
+@pytest.mark.parametrize('reset_during', ['listing', 'longpoll'])
+def test_mirror_cursor_reset_relists_and_prunes(ct, reset_during):
+    state_path = str(ct.tmp_path / 'state.json')
+    archives = {}
+    mirror(ct, '/kept', b'kept', archives)
+    mirror(ct, '/gone', b'gone', archives)
+    del ct.dbx.files['/gone']
+    with open(state_path, 'w') as f:
+        json.dump({'cursor': 'c0', 'archives': archives}, f)
+    uploads = len(ct.glacier.archives)
+
+    relist = [page([files.FolderMetadata(name='d', path_lower='/d')], 'r1',
+                   has_more=True),
+              page([file_metadata('/kept', b'kept')], 'r2')]
+    if reset_during == 'listing':
+        ct.dbx.pages = [cursor_reset()] + relist
+        ct.dbx.longpolls = [StopTest()]
+    else:
+        ct.dbx.pages = [page([], 'c1')] + relist
+        ct.dbx.longpolls = [cursor_reset(files.ListFolderLongpollError),
+                            StopTest()]
+
+    with pytest.raises(StopTest):
+        ct.module.mirror_to_glacier('', 'vault', state_path)
+
+    with open(state_path) as f:
+        state = json.load(f)
+    assert state['cursor'] == 'r2'
+    assert state['relisting'] is False
+    assert list(state['archives']) == ['/kept']
+    assert archives['/gone']['archiveId'] in ct.glacier.deleted
+    # Unchanged content was not sent again
+    assert len(ct.glacier.archives) == uploads - 1
+
+
+def test_interrupted_relist_starts_over(ct):
+    state_path = str(ct.tmp_path / 'state.json')
+    with open(state_path, 'w') as f:
+        json.dump({'cursor': 'c0', 'archives': {}}, f)
+    ct.dbx.pages = [cursor_reset(), page([], 'r1', has_more=True),
+                    StopTest()]
+    with pytest.raises(StopTest):
+        ct.module.mirror_to_glacier('', 'vault', state_path)
+    with open(state_path) as f:
+        state = json.load(f)
+    assert state['relisting'] is True
+
+    ct.dbx.pages = [page([], 'r2')]
+    state = ct.module.mirror_to_glacier('', 'vault', state_path, once=True)
+    assert ct.dbx.calls[-1] == ('list', '')
+    assert state['cursor'] == 'r2'
+    assert state['relisting'] is False
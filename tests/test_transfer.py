@@ -0,0 +1,224 @@
+import json
+import os
+
+import pytest
+
+from .conftest import client_error, file_metadata
+
+
+def data_of(size):
+    return bytes(i % 251 for i in range(size))
+
+
+@pytest.fixture
+def small_parts(ct, monkeypatch):
+    monkeypatch.setattr(ct.module, 'PART_SIZE', 1024 * 1024)
+    return ct
+
+
+def test_multipart_resends_rejected_part(small_parts):
+    ct = small_parts
+    data = data_of(3 * 1024 * 1024 + 512 * 1024)
+    second = f'bytes {1024 * 1024}-{2 * 1024 * 1024 - 1}/*'
+    ct.glacier.corrupt[second] = 1
+
+    archive = ct.module.upload_archive('vault', data)
+    assert archive is not None
+    assert ct.glacier.archives[archive['archiveId']] == data
+    assert ct.glacier.part_calls.count(second) == 2
+    assert len(ct.glacier.part_calls) == 5
+    assert ct.glacier.aborted == []
+
+
+def test_multipart_resends_throttled_part(small_parts):
+    ct = small_parts
+    data = data_of(2 * 1024 * 1024)
+    ct.glacier.unavailable['UploadMultipartPart'] = 2
+
+    archive = ct.module.upload_archive('vault', data)
+    assert ct.glacier.archives[archive['archiveId']] == data
+    assert len(ct.glacier.part_calls) == 4
+
+
+def test_multipart_aborts_after_persistent_rejection(small_parts):
+    ct = small_parts
+    data = data_of(2 * 1024 * 1024)
+    first = f'bytes 0-{1024 * 1024 - 1}/*'
+    ct.glacier.corrupt[first] = ct.module.VERIFY_ATTEMPTS
+
+    assert ct.module.upload_archive('vault', data) is None
+    assert ct.glacier.part_calls.count(first) == ct.module.VERIFY_ATTEMPTS
+    assert len(ct.glacier.aborted) == 1
+    assert ct.glacier.archives == {}
+
+
+def test_multipart_does_not_resend_other_errors(small_parts, monkeypatch):
+    ct = small_parts
+
+    def denied(**kwargs):
+        ct.glacier.part_calls.append(kwargs['range'])
+        raise client_error('AccessDeniedException', 'UploadMultipartPart')
+
+    monkeypatch.setattr(ct.glacier, 'upload_multipart_part', denied)
+    assert ct.module.upload_archive('vault', data_of(2 * 1024 * 1024)) is None
+    # Each part is tried once; nothing is re-sent
+    assert len(set(ct.glacier.part_calls)) == len(ct.glacier.part_calls)
+    assert len(ct.glacier.aborted) == 1
+
+
+def test_single_upload_resent_after_rejection(ct):
+    ct.glacier.corrupt['single'] = 1
+    archive = ct.module.upload_archive('vault', b'payload')
+    assert ct.glacier.archives[archive['archiveId']] == b'payload'
+
+    ct.glacier.corrupt['single'] = ct.module.VERIFY_ATTEMPTS
+    assert ct.module.upload_archive('vault', b'payload') is None
+
+
+def test_download_to_cache_retries_corrupt_download(ct):
+    ct.dbx.files['/a'] = b'contents'
+    metadata = file_metadata('/a', b'contents')
+    ct.dbx.corrupt_downloads = 1
+    with ct.module.download_to_cache(ct.dbx, metadata) as path:
+        with open(path, 'rb') as f:
+            assert f.read() == b'contents'
+    assert ct.dbx.calls.count(('download', '/a')) == 2
+
+    # Served from the cache the second time
+    with ct.module.download_to_cache(ct.dbx, metadata) as path:
+        assert path is not None
+    assert ct.dbx.calls.count(('download', '/a')) == 2
+
+
+def test_download_to_cache_gives_up(ct):
+    ct.dbx.files['/a'] = b'contents'
+    ct.dbx.corrupt_downloads = ct.module.VERIFY_ATTEMPTS
+    with ct.module.download_to_cache(
+        ct.dbx, file_metadata('/a', b'contents')
+    ) as path:
+        assert path is None
+    assert ct.cache.stats()['entries'] == 0
+    assert not [name for name in os.listdir(ct.cache.cache_dir)]
+
+
+def retrieval_job(ct, data):
+    archive_id = ct.module.upload_archive('vault', data)['archiveId']
+    return archive_id, ct.module.retrieve_archive('vault', archive_id)['jobId']
+
+
+def test_retrieve_archive_results_retries_corrupt_output(ct):
+    archive_id, job_id = retrieval_job(ct, b'archived')
+    ct.glacier.corrupt[job_id] = 1
+    path = ct.module.retrieve_archive_results('vault', job_id, archive_id)
+    with open(path, 'rb') as f:
+        assert f.read() == b'archived'
+
+
+def test_retrieve_archive_results_gives_up(ct):
+    archive_id, job_id = retrieval_job(ct, b'archived')
+    ct.glacier.corrupt[job_id] = ct.module.VERIFY_ATTEMPTS
+    assert ct.module.retrieve_archive_results('vault', job_id,
+                                              archive_id) is None
+    assert archive_id not in ct.cache
+
+
+@pytest.fixture
+def local_file(ct, monkeypatch):
+    path = ct.tmp_path / 'local.txt'
+    path.write_bytes(b'settings')
+    monkeypatch.setattr(ct.module, 'LOCALFILE', str(path))
+    monkeypatch.setattr(ct.module, 'BACKUPPATH', '/backup.txt')
+    return ct
+
+
+def test_backup_resends_on_mismatch(local_file):
+    ct = local_file
+    ct.dbx.corrupt_uploads = 1
+    ct.module.backup()
+    assert ct.dbx.files['/backup.txt'] == b'settings'
+    assert ct.dbx.calls.count(('upload', '/backup.txt')) == 2
+
+
+def test_backup_exits_after_persistent_mismatch(local_file):
+    ct = local_file
+    ct.dbx.corrupt_uploads = ct.module.VERIFY_ATTEMPTS
+    with pytest.raises(SystemExit):
+        ct.module.backup()
+    assert (ct.dbx.calls.count(('upload', '/backup.txt'))
+            == ct.module.VERIFY_ATTEMPTS)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def test_scrub_mirror_reports_drift_at_bounded_rate(ct, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(ct.module, 'time', clock)
+    ct.dbx.files.update({'/same': b'same', '/changed': b'new',
+                         '/folder': None})
+    archive_id = ct.module.upload_archive('vault', b'same')['archiveId']
+
+    def archived(path, data, archive_id='gone'):
+        return {'archiveId': archive_id, 'content_hash':
+                file_metadata(path, data).content_hash}
+
+    state = {'cursor': 'c1', 'retry': [], 'relisting': False, 'archives': {
+        '/same': archived('/same', b'same', archive_id),
+        '/changed': archived('/changed', b'old', archive_id),
+        '/folder': archived('/folder', b'was a file', archive_id),
+        '/missing': archived('/missing', b'missing'),
+    }}
+    state_path = ct.tmp_path / 'state.json'
+    state_path.write_text(json.dumps(state))
+    before = state_path.read_bytes()
+
+    inventory = ct.module.retrieve_inventory_results(
+        'vault', ct.module.retrieve_inventory('vault')['jobId']
+    )
+    report = ct.module.scrub_mirror(str(state_path), sample_rate=1.0,
+                                    requests_per_second=4,
+                                    inventory=inventory)
+    assert report == {'checked': 4, 'mismatched': ['/changed', '/folder'],
+                      'missing': ['/missing'], 'unarchived': ['/missing']}
+    # The first request goes out at once, the others are spaced out
+    assert clock.sleeps == [0.25, 0.25, 0.25]
+    assert sum(call[0] == 'get_metadata' for call in ct.dbx.calls) == 4
+    # Drift is reported, not repaired
+    assert state_path.read_bytes() == before
+    assert ct.dbx.calls.count(('download', '/changed')) == 0
+
+
+def test_restore_counts_one_lookup(local_file):
+    ct = local_file
+    ct.dbx.files['/backup.txt'] = b'settings'
+    ct.module.restore('0123456789')
+    ct.module.restore('0123456789')
+    assert ct.dbx.calls.count(('download', '/backup.txt')) == 1
+    stats = ct.cache.stats()
+    assert (stats['hits'], stats['misses']) == (1, 1)
+
+
+def test_restore_archive_polls_count_no_misses(ct):
+    archive_id = ct.module.upload_archive('vault', b'archived')['archiveId']
+    dest = str(ct.tmp_path / 'restored')
+    restored, job_id = ct.module.restore_archive('vault', archive_id, dest)
+    assert not restored
+    ct.glacier.running_jobs.add(job_id)
+    assert ct.module.restore_archive('vault', archive_id, dest,
+                                     job_id) == (False, job_id)
+    ct.glacier.running_jobs.clear()
+    assert ct.module.restore_archive('vault', archive_id, dest,
+                                     job_id) == (True, None)
+    assert ct.module.restore_archive('vault', archive_id, dest) == (True, None)
+    stats = ct.cache.stats()
+    assert (stats['hits'], stats['misses']) == (1, 1)